@@ -1,5 +1,6 @@
-import pandas as pd
+import os
 import duckdb
+from parquet_cache import csv_to_parquet
 
 # Concept IDs 
 AUD_ICD = [
@@ -21,91 +22,23 @@ AUD_ICD = [code.replace('.', '') for code in AUD_ICD]
 
 data_path= '/media/volume/GLP/RDRP_6263_AUD/'
 results_path= 'results/'
+# One-time Parquet copies of the source CSVs, kept out of the (possibly shared) data directory
+parquet_cache_path = f'{results_path}parquet_cache/'
+output_path = f'{results_path}aud_patients_ICD_AUD_rule.parquet'
+
+# Number of DuckDB worker threads
+n_threads = os.cpu_count()
 
 # Initialize DuckDB connection
 print('Initializing DuckDB connection...')
 con = duckdb.connect(database=':memory:')
+con.execute(f'PRAGMA threads={n_threads}')
 
-# Create AUD_ICD list as SQL-compatible string
-aud_icd_sql = "', '".join(AUD_ICD)
-
-print('Loading and processing data with DuckDB (efficient for large files)...')
-# Use DuckDB to query CSV directly without loading everything into memory
-# This is much faster than pandas for large files!
-query = f"""
-WITH processed_conditions AS (
-    SELECT 
-        person_id,
-        condition_source_value,
-        visit_occurrence_id,
-        -- Extract ICD code: remove prefix before ^^, remove trailing ^, remove dots
-        REPLACE(RTRIM(SPLIT_PART(condition_source_value, '^^', 2), '^'), '.', '') AS processed_code
-    FROM read_csv_auto('{data_path}r6263_condition_occurrence.csv')
-    WHERE condition_source_value IS NOT NULL
-)
-SELECT 
-    person_id,
-    condition_source_value,
-    visit_occurrence_id,
-    processed_code
-FROM processed_conditions
-WHERE processed_code IN ('{aud_icd_sql}')
-"""
+condition_parquet = csv_to_parquet(con, f'{data_path}r6263_condition_occurrence.csv', parquet_cache_path)
+visit_parquet = csv_to_parquet(con, f'{data_path}r6263_visit_occurrence.csv', parquet_cache_path)
 
-print('Executing query to filter AUD ICD codes...')
-aud_occurrence = con.execute(query).df()
-
-# Show sample of matched codes
-print(f"\n{'='*80}")
-print(f"Found {len(aud_occurrence)} AUD ICD code records")
-if len(aud_occurrence) > 0:
-    print(f"\nSample of processed codes (first 10):")
-    print(aud_occurrence[['condition_source_value', 'processed_code']].head(10))
-
-# Merge with visit information (load CSV for visit data)
-print('\nMerging with visit occurrence data...')
-visit_query = f"""
-SELECT 
-    visit_occurrence_id,
-    visit_concept_id
-FROM read_csv_auto('{data_path}r6263_visit_occurrence.csv')
-"""
-all_visit = con.execute(visit_query).df()
-aud_occurrence = aud_occurrence.merge(all_visit, on='visit_occurrence_id', how='left')
-
-# Drop the processed_code column as we don't need it anymore
-aud_occurrence = aud_occurrence.drop(columns=['processed_code'])
-
-# Save the result to a CSV file (optional)
-def calculate_visit_counts(aud_occurrence):
-    """
-    Calculate inpatient and outpatient visit counts for each patient.
-    Based on actual visit_concept_id values in the dataset:
-    - 9201: Inpatient Visit
-    - 9202: Outpatient Visit  
-    - 9203: Emergency Room Visit (counted as inpatient)
-    """
-    # Map visit_concept_id to categories
-    aud_occurrence['visit_category'] = aud_occurrence['visit_concept_id'].map(
-        lambda x: 'inpatient' if x in [9201] else 'outpatient' if x in [9202] else None
-    )
-
-    # Filter out rows with undefined visit categories
-    aud_occurrence = aud_occurrence.dropna(subset=['visit_category'])
-
-    # Count occurrences by category
-    visit_counts = aud_occurrence.groupby(['person_id', 'visit_category']).size().unstack(fill_value=0)
-    visit_counts = visit_counts.rename(columns={'inpatient': 'inpatient_count', 'outpatient': 'outpatient_count'})
-
-    # Ensure both columns exist even if one type of visit is missing
-    if 'inpatient_count' not in visit_counts:
-        visit_counts['inpatient_count'] = 0
-    if 'outpatient_count' not in visit_counts:
-        visit_counts['outpatient_count'] = 0
-
-    visit_counts = visit_counts.reset_index()
-
-    return visit_counts[['person_id', 'inpatient_count', 'outpatient_count']]
+# Create AUD_ICD list as a SQL VALUES list, matched with a hash semi join
+aud_icd_values = ", ".join(f"('{code}')" for code in AUD_ICD)
 
 # Actual visit_concept_id values in this dataset:
 # 9201: Inpatient Visit (counted as inpatient)
@@ -118,26 +51,71 @@ def calculate_visit_counts(aud_occurrence):
 # 8717: Inpatient Hospital
 # 8756: Outpatient Hospital
 
-# Display visit type distribution
-print("Visit type distribution:")
-print(aud_occurrence['visit_concept_id'].value_counts())
-print(f"\nTotal unique patients with AUD ICD codes: {aud_occurrence['person_id'].nunique()}")
+print(f'Running ICD pipeline in a single DuckDB query ({n_threads} threads)...')
+# Filter, join, aggregate and apply the visit rule in one pass over each file,
+# writing the qualifying patients straight to Parquet without going through pandas.
+# Rule: at least one inpatient visit or at least two outpatient visits.
+query = f"""
+COPY (
+    WITH processed_conditions AS (
+        SELECT 
+            person_id,
+            visit_occurrence_id,
+            -- Extract ICD code: remove prefix before ^^, remove trailing ^, remove dots
+            REPLACE(RTRIM(SPLIT_PART(condition_source_value, '^^', 2), '^'), '.', '') AS processed_code
+        FROM read_parquet('{condition_parquet}')
+        WHERE condition_source_value IS NOT NULL
+    ),
+    visits AS (
+        SELECT 
+            visit_occurrence_id,
+            visit_concept_id
+        FROM read_parquet('{visit_parquet}')
+    ),
+    aud_codes AS (
+        SELECT code FROM (VALUES {aud_icd_values}) AS aud(code)
+    ),
+    aud_conditions AS (
+        SELECT 
+            c.person_id,
+            c.visit_occurrence_id
+        FROM processed_conditions c
+        SEMI JOIN aud_codes a ON c.processed_code = a.code
+    ),
+    aud_visits AS (
+        SELECT 
+            c.person_id,
+            v.visit_concept_id
+        FROM aud_conditions c
+        JOIN visits v USING (visit_occurrence_id)
+        -- Keep only categorized visits (undefined visit types are excluded from the counts)
+        WHERE v.visit_concept_id IN (9201, 9202)
+    )
+    SELECT 
+        person_id,
+        COUNT(*) FILTER (WHERE visit_concept_id = 9201) AS inpatient_count,
+        COUNT(*) FILTER (WHERE visit_concept_id = 9202) AS outpatient_count
+    FROM aud_visits
+    GROUP BY person_id
+    HAVING inpatient_count >= 1 OR outpatient_count >= 2
+    ORDER BY person_id
+) TO '{output_path}' (FORMAT PARQUET)
+"""
+con.execute(query)
 
-# Calculate visit counts by patient
-patient_counts = calculate_visit_counts(aud_occurrence)
-def filter_patients_by_visits(patient_counts):
-    """
-    Filter patients with at least one inpatient visit or at least two outpatient visits.
-    """
-    filtered_patients = patient_counts[
-        (patient_counts['inpatient_count'] >= 1) | (patient_counts['outpatient_count'] >= 2)
-    ]
-    return filtered_patients
-filtered_patients=filter_patients_by_visits(patient_counts)
-filtered_patients.to_csv(results_path+'aud_patients_ICD_AUD_rule.csv',index=False)
+# Summarize the saved results
+n_patients, n_inpatient, n_outpatient = con.execute(f"""
+SELECT 
+    COUNT(*),
+    COUNT(*) FILTER (WHERE inpatient_count >= 1),
+    COUNT(*) FILTER (WHERE outpatient_count >= 2)
+FROM read_parquet('{output_path}')
+""").fetchone()
 
 # Close DuckDB connection
 con.close()
 
-print("Extraction complete. Results saved")
-print(f"Final results: {len(filtered_patients)} patients meet the criteria (inpatient>=1 or outpatient>=2)")
\ No newline at end of file
+print(f"Extraction complete. Results saved to {output_path}")
+print(f"  - Patients with inpatient>=1: {n_inpatient}")
+print(f"  - Patients with outpatient>=2: {n_outpatient}")
+print(f"Final results: {n_patients} patients meet the criteria (inpatient>=1 or outpatient>=2)")
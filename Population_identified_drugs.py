@@ -1,8 +1,10 @@
-import pandas as pd
 import duckdb
+from parquet_cache import csv_to_parquet
 
 data_path= '/media/volume/GLP/RDRP_6263_AUD/'
 results_path= 'results/'
+# One-time Parquet copies of the source CSVs, kept out of the (possibly shared) data directory
+parquet_cache_path = f'{results_path}parquet_cache/'
 
 concept_ids=[21604824,1714319,21604821,36224129,43144973,
                    40035385,41207533,40035384,36224128,35153127,
@@ -18,6 +20,8 @@ drug_concept_ids=[40175986, 40175987, 21136574, 21097352, 21126678, 21038472, 21
 print('Initializing DuckDB connection...')
 con = duckdb.connect(database=':memory:')
 
+drug_parquet = csv_to_parquet(con, f'{data_path}r6263_drug_exposure.csv', parquet_cache_path)
+
 # Create drug_concept_ids list as SQL-compatible string
 drug_ids_sql = ", ".join(map(str, drug_concept_ids))
 
@@ -27,7 +31,7 @@ query = f"""
 SELECT 
     person_id,
     COUNT(DISTINCT drug_concept_id) as drug_count
-FROM read_csv_auto('{data_path}r6263_drug_exposure.csv')
+FROM read_parquet('{drug_parquet}')
 WHERE drug_concept_id IN ({drug_ids_sql})
 GROUP BY person_id
 HAVING COUNT(DISTINCT drug_concept_id) >= 1
@@ -35,21 +39,33 @@ ORDER BY drug_count DESC
 """
 
 print('Executing query to count unique AUD medications per patient...')
-drug_counts = con.execute(query).df()
+# Keep the result in a DuckDB temporary table; it is summarized and exported below
+# without converting to pandas
+con.execute(f"CREATE TEMP TABLE drug_counts AS {query}")
+n_patients = con.execute("SELECT COUNT(*) FROM drug_counts").fetchone()[0]
 
 # Show statistics
 print(f"\n{'='*80}")
-print(f"Found {len(drug_counts)} patients with AUD medications")
+print(f"Found {n_patients} patients with AUD medications")
 print(f"\nDrug count distribution:")
-print(drug_counts['drug_count'].describe())
+con.sql("""
+SELECT 
+    COUNT(*) AS count,
+    AVG(drug_count) AS mean,
+    STDDEV(drug_count) AS std,
+    MIN(drug_count) AS min,
+    QUANTILE_CONT(drug_count, [0.25, 0.5, 0.75]) AS quartiles,
+    MAX(drug_count) AS max
+FROM drug_counts
+""").show()
 print(f"\nSample of results (first 10 patients):")
-print(drug_counts.head(10))
+con.sql("SELECT * FROM drug_counts LIMIT 10").show()
 
 # Save results
-drug_counts.to_csv(f'{results_path}aud_patients_drug_rule.csv', index=False)
+con.table("drug_counts").write_csv(f'{results_path}aud_patients_drug_rule.csv')
 
 # Close DuckDB connection
 con.close()
 
 print("\nExtraction complete. Results saved to 22aud_patients_drug_rule.csv")
-print(f"All {len(drug_counts)} patients have medication_count >= 1")
\ No newline at end of file
+print(f"All {n_patients} patients have medication_count >= 1")
\ No newline at end of file
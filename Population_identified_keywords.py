@@ -1,19 +1,36 @@
 import os
 import re
 import pandas as pd
+import duckdb
+import pyarrow.parquet as pq
 import glob
+from collections import deque
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 import pickle
 import time
 import gc  # For garbage collection
 
+try:
+    import hyperscan  # Optional: multi-pattern SIMD regex matching
+except ImportError:
+    hyperscan = None
+
 # Paths
 keywords_path = 'keywords_regex_precise.csv'
 notes_dir = '/media/volume/GLP/RDRP_6263_AUD/notes/'
 results_path = 'results/'
 intermediate_path = 'results/intermediate_keywords/'  # Store intermediate results
 
+# Number of worker processes
+n_processes = 4  # User specified
+
+# Number of notes read from parquet and sent to a worker at a time
+notes_per_chunk = 10000
+
+# Note columns read from the parquet files
+note_columns = ['OMOP_PERSON_ID', 'ENCOUNTER_ID', 'PHYSIOLOGIC_TIME', 'REPORT_TEXT']
+
 # Create intermediate directory
 os.makedirs(intermediate_path, exist_ok=True)
 
@@ -23,6 +40,49 @@ aud_keywords = pd.read_csv(keywords_path)
 aud_patterns = [(re.compile(regex, re.IGNORECASE), root) 
                 for root, regex in zip(aud_keywords['Root'], aud_keywords['Regex'])]
 
+# Combine all keyword regexes into one alternation so a sentence without any
+# keyword is rejected by a single regex search instead of one search per pattern
+aud_alternation = re.compile('|'.join(f'(?:{regex})' for regex in aud_keywords['Regex']),
+                             re.IGNORECASE)
+
+def uses_anchors(regex):
+    """Return True if regex contains ^, $, \\A or \\Z outside a character class."""
+    i, in_class = 0, False
+    while i < len(regex):
+        char = regex[i]
+        if char == '\\':
+            if not in_class and regex[i + 1:i + 2] in ('A', 'Z'):
+                return True
+            i += 2
+            continue
+        if in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+            # A ']' right after '[' or '[^' is a literal member of the class
+            i += 2 if regex[i + 1:i + 2] == ']' else 3 if regex[i + 1:i + 3] == '^]' else 1
+            continue
+        elif char in '^$':
+            return True
+        i += 1
+    return False
+
+# The same alternation is used as a note-level prefilter evaluated by DuckDB's
+# vectorized regex functions (RE2 syntax). This is only safe for unanchored regexes:
+# keywords are matched per sentence, so ^ and $ match at sentence boundaries, while
+# DuckDB only sees the whole note. The prefilter is also disabled if a keyword regex
+# uses syntax RE2 does not support (e.g. lookarounds); every note is then scanned
+if any(uses_anchors(regex) for regex in aud_keywords['Regex']):
+    print("Keyword regexes use anchors, note prefilter disabled")
+    note_prefilter_pattern = None
+else:
+    try:
+        duckdb.execute("SELECT regexp_matches('', ?, 'i')", [aud_alternation.pattern])
+        note_prefilter_pattern = aud_alternation.pattern
+    except duckdb.Error:
+        print("Keyword regexes are not RE2-compatible, note prefilter disabled")
+        note_prefilter_pattern = None
+
 print(f"Loaded {len(aud_patterns)} AUD keyword patterns")
 
 # Define negation patterns
@@ -45,264 +105,506 @@ legal_admin_filter_pattern = re.compile(
     re.IGNORECASE
 )
 
-def check_sentence_for_keywords(sentence, aud_patterns, negation_pattern, 
-                                  context_filter_pattern, legal_admin_filter_pattern):
+# Sentences are the runs of text between delimiters [.!?;:\n]; each match starts and ends
+# on a non-whitespace character, so its span is the stripped sentence's offsets. The
+# leading whitespace is not part of the pattern: a leading \s* followed by [^.!?;:\n]*
+# would try every split of a whitespace run and take cubic time on padded notes
+sentence_pattern = re.compile(r'[^.!?;:\n\s](?:[^.!?;:\n]*[^.!?;:\n\s])?')
+
+def split_sentences(text):
+    """
+    Reference sentence split: the stripped, non-empty runs of text between delimiters.
+    """
+    return [sentence.strip() for sentence in re.split(r'[.!?;:\n]', text) if sentence.strip()]
+
+# Check the sentence pattern against the reference split once at startup, on a note
+# padded with long whitespace runs before a delimiter and at the end of the text
+sentence_check_text = ('Patient reports alcohol use daily' + ' ' * 20000 + '.' 
+                       + ' \t Denies etoh ; ' + ' ' * 20000)
+assert ([match.group() for match in sentence_pattern.finditer(sentence_check_text)] 
+        == split_sentences(sentence_check_text)), "Sentence pattern disagrees with split"
+
+# Negation, context and legal/administrative filters combined, so the Python re
+# path rejects an excluded sentence with a single search
+exclusion_pattern = re.compile(
+    '|'.join(pattern.pattern for pattern in 
+             [negation_pattern, context_filter_pattern, legal_admin_filter_pattern]),
+    re.IGNORECASE
+)
+
+def compile_hyperscan_database(expressions):
+    """
+    Compile regexes into a single case-insensitive Hyperscan block-mode database,
+    using each expression's list index as its match id.
+    Returns None if Hyperscan is not installed or cannot compile the expressions.
+    """
+    if hyperscan is None:
+        return None
+    
+    # Hyperscan rejects \b in UCP (Unicode property) mode, so \b and case folding are
+    # ASCII-only on this path; Python's re applies them to all Unicode letters, so
+    # check_sentence_with_hyperscan only scans ASCII sentences
+    flags = hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_SINGLEMATCH
+    database = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    try:
+        database.compile(
+            expressions=[expression.encode('utf-8') for expression in expressions],
+            ids=list(range(len(expressions))),
+            elements=len(expressions),
+            flags=[flags] * len(expressions)
+        )
+    except hyperscan.error as e:
+        print(f"Hyperscan could not compile patterns ({e}), falling back to Python re")
+        return None
+    return database
+
+# Each unique keyword root gets an integer id, so matches are recorded in a small
+# fixed-size bytearray indexed by root id instead of a set of root names
+root_names = list(dict.fromkeys(aud_keywords['Root']))
+pattern_root_ids = [root_names.index(root) for root in aud_keywords['Root']]
+
+# Keyword regexes take ids 0..K-1 and the exclusion filters the ids after them,
+# so one Hyperscan scan per sentence finds both keywords and exclusions
+sentence_database = compile_hyperscan_database(
+    list(aud_keywords['Regex']) + [negation_pattern.pattern, context_filter_pattern.pattern,
+                                   legal_admin_filter_pattern.pattern]
+)
+
+# Per-sentence Hyperscan matches, indexed by pattern id; reused for every sentence
+sentence_hits = bytearray(len(pattern_root_ids) + 3)
+
+def on_sentence_match(pattern_id, start, end, flags, hits):
+    """
+    Hyperscan match callback: mark the pattern that matched.
+    """
+    hits[pattern_id] = 1
+
+# The hot per-sentence functions below bind the compiled patterns, their methods and
+# lookup tables as default arguments, which are read as fast locals on every call
+# instead of being resolved as globals and attributes
+
+def check_sentence_for_keywords(sentence, note_hits, _has_keyword=aud_alternation.search, 
+                                _is_excluded=exclusion_pattern.search,
+                                _patterns=[(pattern.search, root_id) for (pattern, _), root_id 
+                                           in zip(aud_patterns, pattern_root_ids)]):
     """
     Check if a sentence contains AUD keywords with negation and context filtering.
-    Returns: (matched_roots, is_valid_match)
+    Matched keyword roots are marked in note_hits by root id.
+    Returns: is_valid_match
+    """
+    # Reject keyword-free sentences first: most sentences have no keyword, so this single
+    # alternation search is usually the only regex run and the exclusion search is skipped
+    if not _has_keyword(sentence):
+        return False
+    
+    # Skip sentences with negations, context filtering (recommendations, family history, etc.)
+    # or legal/administrative content
+    if _is_excluded(sentence):
+        return False
+    
+    # Match AUD-related patterns. Every pattern is checked, since overlapping keywords
+    # would otherwise be hidden behind the first alternative that matches.
+    is_valid = False
+    for search, root_id in _patterns:
+        if search(sentence):
+            note_hits[root_id] = 1
+            is_valid = True
+    
+    return is_valid
+
+def check_sentence_with_hyperscan(sentence, note_hits, _database=sentence_database, 
+                                  _on_match=on_sentence_match, _hits=sentence_hits,
+                                  _no_hits=bytes(len(sentence_hits)),
+                                  _pattern_root_ids=pattern_root_ids,
+                                  _n_keywords=len(pattern_root_ids),
+                                  _check_with_re=check_sentence_for_keywords):
     """
-    matched_roots = set()
+    Hyperscan version of check_sentence_for_keywords.
+    Returns: is_valid_match
+    """
+    # Without HS_FLAG_UCP, \b and case folding are ASCII-only in Hyperscan but Unicode-aware
+    # in Python re, so sentences with non-ASCII text are checked with re to match its results
+    if not sentence.isascii():
+        return _check_with_re(sentence, note_hits)
     
-    # Skip sentences with negations
-    if negation_pattern.search(sentence):
-        return matched_roots, False
+    _database.scan(sentence.encode('utf-8'), match_event_handler=_on_match, context=_hits)
     
-    # Skip sentences with context filtering (recommendations, family history, etc.)
-    if context_filter_pattern.search(sentence):
-        return matched_roots, False
+    pattern_id = _hits.find(1)
+    if pattern_id < 0:
+        return False
     
-    # Skip sentences with legal/administrative content
-    if legal_admin_filter_pattern.search(sentence):
-        return matched_roots, False
+    # Skip sentences without keywords, or with negations, context filtering or
+    # legal/administrative content
+    if pattern_id >= _n_keywords or _hits.find(1, _n_keywords) >= 0:
+        _hits[:] = _no_hits
+        return False
     
-    # Match AUD-related patterns
-    for pattern, root in aud_patterns:
-        if pattern.search(sentence):
-            matched_roots.add(root)
+    while 0 <= pattern_id < _n_keywords:
+        note_hits[_pattern_root_ids[pattern_id]] = 1
+        pattern_id = _hits.find(1, pattern_id + 1)
     
-    return matched_roots, len(matched_roots) > 0
+    _hits[:] = _no_hits
+    return True
 
-def process_note_text(text, aud_patterns, negation_pattern, 
-                      context_filter_pattern, legal_admin_filter_pattern):
+def hyperscan_agrees_with_re(sentences):
+    """
+    Run sentences through both sentence checks and confirm they find the same roots.
+    """
+    for sentence in sentences:
+        hyperscan_hits = bytearray(len(root_names))
+        re_hits = bytearray(len(root_names))
+        hyperscan_valid = check_sentence_with_hyperscan(sentence, hyperscan_hits)
+        re_valid = check_sentence_for_keywords(sentence, re_hits)
+        if hyperscan_valid != re_valid or hyperscan_hits != re_hits:
+            print(f"Hyperscan and Python re disagree on: {sentence!r}")
+            return False
+    return True
+
+# Exercise the Hyperscan path once at startup: every root on its own, in upper case,
+# behind a negation, a family-history context and a legal/administrative word, and
+# next to non-ASCII text where ASCII-only \b would differ from Python re
+if sentence_database is not None:
+    probe_sentences = [template.format(root) for root in root_names for template in 
+                       ['Patient reports {} use', 'PATIENT REPORTS {} USE', 
+                        'Patient denies {} use', 'Father has a history of {}', 
+                        'Consent form reviewed for {}', 'Patient drinks {} daily, asked about formé',
+                        'Patient at the cafénot sure about {}']]
+    if not hyperscan_agrees_with_re(probe_sentences):
+        print("Falling back to Python re")
+        sentence_database = None
+print(f"Regex engine: {'Hyperscan' if sentence_database is not None else 'Python re'}")
+
+# Sentence check used for every sentence, depending on the available regex engine
+check_sentence = (check_sentence_with_hyperscan if sentence_database is not None 
+                  else check_sentence_for_keywords)
+
+def process_note_text(text, _check_sentence=check_sentence, 
+                      _find_sentences=sentence_pattern.finditer,
+                      _root_names=root_names):
     """
     Process note text and extract AUD-related information.
-    Returns: (aud_roots, aud_roots_count, matched_sentences)
+    Sentences are scanned until every keyword root has been found.
+    Matched sentences are returned as (start, length) offsets into the note text.
+    Returns: (aud_roots, aud_roots_count, matched_sentence_offsets)
     """
-    if pd.isna(text) or not text:
-        return [], 0, []
+    if not text:
+        return [], 0, ()
     
-    # Split text into sentences
-    sentences = re.split(r'[.!?;:\n]+', text)
-    
-    all_aud_roots = set()
-    matched_sentences = []
+    note_hits = bytearray(len(_root_names))
+    matched_offsets = []
     
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if not sentence or len(sentence) < 10:  # Skip very short sentences
+    # Split text into sentences
+    for sentence_match in _find_sentences(text):
+        sentence = sentence_match.group()
+        if len(sentence) < 10:  # Skip very short sentences
             continue
         
-        roots, is_valid = check_sentence_for_keywords(
-            sentence, aud_patterns, negation_pattern, 
-            context_filter_pattern, legal_admin_filter_pattern
-        )
-        
-        if is_valid and roots:
-            all_aud_roots.update(roots)
-            matched_sentences.append(sentence)
+        if _check_sentence(sentence, note_hits):
+            start = sentence_match.start()
+            matched_offsets.append((start, len(sentence)))
+            
+            # Stop once every keyword root has been found: the remaining sentences cannot
+            # change aud_roots or aud_roots_count, only add more matched sentences
+            if 0 not in note_hits:
+                break
+    
+    if not matched_offsets:
+        return [], 0, ()
     
-    return list(all_aud_roots), len(all_aud_roots), matched_sentences
+    # Convert the root bitset to root names once per matched note
+    aud_roots = [root for root, hit in zip(_root_names, note_hits) if hit]
+    return aud_roots, len(aud_roots), tuple(matched_offsets)
 
-def process_single_parquet(args):
+def process_note_chunk(batch):
     """
-    Process a single parquet file and save results immediately.
-    Returns: (file_name, num_matches, num_notes, error)
+    Process an Arrow record batch of notes in a worker process.
+    Returns: list with one result record per note with matches
     """
-    file_path, file_idx, total_files = args
-    file_name = os.path.basename(os.path.dirname(file_path))
+    # Python objects are only created here, in the worker; the parent passes the Arrow
+    # batch through untouched
+    person_ids, note_ids, note_dates, report_texts = (batch.column(column).to_pylist() 
+                                                      for column in note_columns)
+    results = []
     
-    # Check if already processed
-    output_file = os.path.join(intermediate_path, f'{file_name}_results.csv')
-    if os.path.exists(output_file):
-        # Don't load the parquet file for skipped files to save memory
-        # Return 0 for notes count - we'll get accurate count from intermediate files later
-        return file_name, 'SKIPPED', 0, None
+    for person_id, note_id, note_date, report_text in zip(person_ids, note_ids, 
+                                                           note_dates, report_texts):
+        # Process note text
+        aud_roots, aud_roots_count, matched_sentence_offsets = process_note_text(report_text)
+        
+        # Only save notes with matches
+        if aud_roots_count > 0:
+            results.append({
+                'person_id': person_id,
+                'note_id': note_id,
+                'note_date': note_date,
+                'aud_roots': aud_roots,
+                'aud_roots_count': aud_roots_count,
+                # Sentence text is REPORT_TEXT[start:start + length] of the source note
+                'matched_sentence_offsets': matched_sentence_offsets
+            })
     
-    results = []
+    return results
+
+def read_note_chunks(file_path):
+    """
+    Stream the notes of a parquet file through DuckDB, reading only the columns that are
+    used and keeping only notes with a keyword match. Batches hold notes_per_chunk notes
+    counted after that filter, so most files are a single batch; process_parquet_files
+    keeps several files in flight so such files still spread across the workers.
+    Yields: Arrow record batches of candidate notes
+    """
+    # Drop notes without any keyword match before any per-sentence Python work
+    keyword_filter = ''
+    if note_prefilter_pattern is not None:
+        escaped_pattern = note_prefilter_pattern.replace("'", "''")
+        keyword_filter = f"WHERE regexp_matches(REPORT_TEXT, '{escaped_pattern}', 'i')"
     
+    query = f"""
+    SELECT {', '.join(note_columns)}
+    FROM read_parquet('{file_path}')
+    {keyword_filter}
+    """
+    with duckdb.connect(database=':memory:') as con:
+        result = con.execute(query)
+        # to_arrow_reader replaces the deprecated fetch_record_batch in newer DuckDB releases
+        read_batches = getattr(result, 'to_arrow_reader', None) or result.fetch_record_batch
+        yield from read_batches(notes_per_chunk)
+
+def get_file_name(file_path):
+    """
+    Name of a notes parquet file, taken from its parent directory.
+    """
+    return os.path.basename(os.path.dirname(file_path))
+
+def start_parquet_file(args):
+    """
+    Set up the state of a parquet file whose notes are about to be read.
+    Returns: dict collecting the file's results until its last batch completes
+    """
+    file_path, file_idx, total_files = args
+    file_name = get_file_name(file_path)
+    tqdm.write(f"\n[{file_idx+1}/{total_files}] Reading: {file_name}")
+    return {
+        'file_path': file_path,
+        'file_name': file_name,
+        'total_notes': 0,
+        'results': [],
+        'pending_batches': 0,
+        'fully_read': False,
+        'error': None
+    }
+
+def collect_oldest_batch(in_flight, progress):
+    """
+    Wait for the oldest batch in flight and add its results to the results of its file.
+    Returns: the file's state if this was its last batch and the file has been fully read, else None
+    """
+    file_state, pending, num_notes = in_flight.popleft()
     try:
-        # Read parquet file
-        print(f"\n[{file_idx+1}/{total_files}] Processing: {file_name}")
-        df = pd.read_parquet(file_path)
-        total_notes = len(df)
-        print(f"    └─ Loaded {total_notes:,} notes")
-        
-        # Process each note in the file with tqdm progress bar
-        matched_count = 0
-        
-        # Use tqdm properly with range iteration
-        for idx in tqdm(range(len(df)), 
-                       desc=f"    Processing", 
-                       ncols=100,
-                       bar_format='{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]'):
-            row = df.iloc[idx]
-            person_id = row['OMOP_PERSON_ID']
-            note_id = row['ENCOUNTER_ID']
-            note_date = row['PHYSIOLOGIC_TIME']
-            report_text = row['REPORT_TEXT']
-            
-            # Process note text
-            aud_roots, aud_roots_count, matched_sentences = process_note_text(
-                report_text, aud_patterns, negation_pattern,
-                context_filter_pattern, legal_admin_filter_pattern
-            )
-            
-            # Only save notes with matches
-            if aud_roots_count > 0:
-                matched_count += 1
-                results.append({
-                    'person_id': person_id,
-                    'note_id': note_id,
-                    'note_date': note_date,
-                    'aud_roots': aud_roots,
-                    'aud_roots_count': aud_roots_count,
-                    'matched_sentences': matched_sentences
-                })
+        file_state['results'].extend(pending.get())
+    except Exception as e:
+        file_state['error'] = file_state['error'] or f"Error: {e}"
+    file_state['pending_batches'] -= 1
+    progress.update(num_notes)
+    if file_state['pending_batches'] == 0 and file_state['fully_read']:
+        return file_state
+    return None
+
+def save_file_results(file_state):
+    """
+    Save the results of a file whose batches have all completed.
+    Returns: (file_name, num_matches, num_notes, error)
+    """
+    file_name = file_state['file_name']
+    results = file_state.pop('results')
+    matched_count = len(results)
+    
+    if file_state['error']:
+        # Nothing is saved, so the file is processed again on the next run
+        return file_name, 0, 0, file_state['error']
+    
+    # Save intermediate results immediately
+    if results:
+        output_file = os.path.join(intermediate_path, f'{file_name}_results.parquet')
+        results_df = pd.DataFrame(results)
+        results_df.to_parquet(output_file, index=False, compression='zstd')
+        tqdm.write(f"    └─ {file_name}: ✓ Found {matched_count:,} matches, "
+                   f"saved to {file_name}_results.parquet")
         
-        # Save intermediate results immediately
-        if results:
-            results_df = pd.DataFrame(results)
-            results_df.to_csv(output_file, index=False)
-            print(f"    └─ ✓ Found {matched_count:,} matches, saved to {file_name}_results.csv")
+        # Clear results_df to free memory
+        del results_df
+    else:
+        tqdm.write(f"    └─ {file_name}: No matches found in this file")
+    
+    # Clear large objects to free memory
+    del results
+    gc.collect()  # Force garbage collection
+    
+    return file_name, matched_count, file_state['total_notes'], None
+
+def process_parquet_files(pending_args, pool):
+    """
+    Process parquet files with the worker pool, saving each file's results as soon as
+    its last batch completes.
+    Yields: (file_name, num_matches, num_notes, error) per file
+    """
+    # The batches of all files share one queue of at most 2 * n_processes tasks: the next
+    # file is read while the batches of the previous files are still running, so files that
+    # are a single batch after the keyword prefilter still keep every worker busy and there
+    # is no barrier at the end of each file. Only a few batches are in flight at a time,
+    # which keeps memory bounded by the batch size rather than the file size.
+    in_flight = deque()
+    with tqdm(desc=f"Candidate notes", 
+              ncols=100,
+              bar_format='{desc}: {n_fmt} [{elapsed}, {rate_fmt}]') as progress:
+        for args in pending_args:
+            file_state = start_parquet_file(args)
+            try:
+                # Candidate notes are streamed batch by batch instead of loaded at once
+                file_state['total_notes'] = pq.ParquetFile(file_state['file_path']).metadata.num_rows
+                for batch in read_note_chunks(file_state['file_path']):
+                    in_flight.append((file_state, pool.apply_async(process_note_chunk, (batch,)), 
+                                      batch.num_rows))
+                    file_state['pending_batches'] += 1
+                    while len(in_flight) >= 2 * n_processes:
+                        finished_file = collect_oldest_batch(in_flight, progress)
+                        if finished_file is not None:
+                            yield save_file_results(finished_file)
+            except Exception as e:
+                file_state['error'] = f"Error: {e}"
             
-            # Clear results_df to free memory
-            del results_df
-        else:
-            print(f"    └─ No matches found in this file")
-        
-        # Clear large objects to free memory
-        del df
-        del results
-        gc.collect()  # Force garbage collection
+            file_state['fully_read'] = True
+            if file_state['pending_batches'] == 0:
+                yield save_file_results(file_state)
         
-        return file_name, matched_count, total_notes, None
-    
-    except Exception as e:
-        # Clean up on error
-        gc.collect()
-        return file_name, 0, 0, f"Error: {e}"
+        while in_flight:
+            finished_file = collect_oldest_batch(in_flight, progress)
+            if finished_file is not None:
+                yield save_file_results(finished_file)
 
-# Get all parquet files
-print('\nFinding all parquet files...')
-parquet_files = sorted(glob.glob(f'{notes_dir}*/part-*.parquet'))
-print(f"Found {len(parquet_files)} parquet files (Total ~32GB)")
+if __name__ == '__main__':
+    # Get all parquet files
+    print('\nFinding all parquet files...')
+    parquet_files = sorted(glob.glob(f'{notes_dir}*/part-*.parquet'))
+    print(f"Found {len(parquet_files)} parquet files (Total ~32GB)")
 
-# Check for existing intermediate results
-existing_results = glob.glob(f'{intermediate_path}*_results.csv')
-print(f"Found {len(existing_results)} previously processed files")
+    # Check for existing intermediate results once, instead of per file
+    existing_results = {os.path.basename(path)[:-len('_results.parquet')] 
+                        for path in glob.glob(f'{intermediate_path}*_results.parquet')}
+    print(f"Found {len(existing_results)} previously processed files")
 
-# Determine number of processes
-n_processes = 4  # User specified
-print(f"\nUsing {n_processes} parallel processes")
-print(f"Intermediate results will be saved to: {intermediate_path}")
-print(f"Each file will be saved immediately after processing (safe from interruption)\n")
-
-# Prepare arguments for processing
-total_files = len(parquet_files)
-file_args = [(f, idx, total_files) for idx, f in enumerate(parquet_files)]
-
-# Process files sequentially with detailed progress tracking
-print("\n" + "="*80)
-print("Processing parquet files...")
-print("(You can safely interrupt and restart - already processed files will be skipped)")
-print("="*80)
-
-start_time = time.time()
-processed_count = 0
-skipped_count = 0
-total_matches = 0
-total_notes_processed = 0
-errors = []
-
-# Process without multiprocessing for more stable execution
-for args in file_args:
-    file_name, num_matches, num_notes, error = process_single_parquet(args)
-    
-    if error:
-        errors.append(f"{file_name}: {error}")
-        print(f"    └─ ✗ Error: {error}")
-    elif num_matches == 'SKIPPED':
-        skipped_count += 1
-        # Don't add to total_notes_processed for skipped files (we don't load them)
-        print(f"\n[{args[1]+1}/{total_files}] Skipped: {file_name} (already processed)")
-    else:
-        processed_count += 1
-        total_matches += num_matches
-        total_notes_processed += num_notes
-
-elapsed_time = time.time() - start_time
-
-# Report processing status
-print(f"\n{'='*80}")
-print(f"Processing Summary:")
-print(f"{'='*80}")
-print(f"Newly processed: {processed_count} files")
-print(f"Skipped (already done): {skipped_count} files")
-if processed_count > 0:
-    print(f"Notes processed in this run: {total_notes_processed:,}")
-    print(f"Matches found in this run: {total_matches:,}")
-    print(f"Match rate: {total_matches/total_notes_processed*100:.2f}%")
-    print(f"Processing speed: {total_notes_processed/elapsed_time:.1f} notes/second")
-print(f"Time elapsed: {elapsed_time/60:.1f} minutes")
-
-if errors:
-    print(f"\n⚠️  Errors encountered: {len(errors)}")
-    for error in errors[:5]:
-        print(f"  - {error}")
-
-# Merge all intermediate results
-print(f"\n{'='*80}")
-print("Merging all intermediate results...")
-print(f"{'='*80}")
-
-all_intermediate_files = glob.glob(f'{intermediate_path}*_results.csv')
-print(f"Found {len(all_intermediate_files)} intermediate result files to merge")
-
-if all_intermediate_files:
-    all_results = []
-    for intermediate_file in tqdm(all_intermediate_files, desc="Merging files"):
-        try:
-            df = pd.read_csv(intermediate_file)
-            all_results.append(df)
-        except Exception as e:
-            print(f"Error reading {intermediate_file}: {e}")
+    print(f"\nUsing {n_processes} parallel processes")
+    print(f"Intermediate results will be saved to: {intermediate_path}")
+    print(f"Each file will be saved immediately after processing (safe from interruption)\n")
+
+    # Prepare arguments for processing, leaving out already processed files
+    total_files = len(parquet_files)
+    file_args = [(f, idx, total_files) for idx, f in enumerate(parquet_files)]
+    pending_args = [args for args in file_args if get_file_name(args[0]) not in existing_results]
+
+    # Process files in parallel with detailed progress tracking
+    print("\n" + "="*80)
+    print("Processing parquet files...")
+    print("(You can safely interrupt and restart - already processed files will be skipped)")
+    print("="*80)
+
+    start_time = time.time()
+    processed_count = 0
+    # Skipped files are not loaded, so they don't add to total_notes_processed
+    skipped_count = len(file_args) - len(pending_args)
+    print(f"Skipping {skipped_count} already processed files")
+    total_matches = 0
+    total_notes_processed = 0
+    errors = []
+
+    # The notes of every file are split into chunks that are processed by a single
+    # persistent pool, so a few very large files and many small files both use every core
+    with Pool(n_processes) as pool:
+        for file_name, num_matches, num_notes, error in process_parquet_files(pending_args, pool):
+            if error:
+                errors.append(f"{file_name}: {error}")
+                tqdm.write(f"    └─ ✗ {file_name}: {error}")
+            else:
+                processed_count += 1
+                total_matches += num_matches
+                total_notes_processed += num_notes
+
+    elapsed_time = time.time() - start_time
+
+    # Report processing status
+    print(f"\n{'='*80}")
+    print(f"Processing Summary:")
+    print(f"{'='*80}")
+    print(f"Newly processed: {processed_count} files")
+    print(f"Skipped (already done): {skipped_count} files")
+    if processed_count > 0:
+        print(f"Notes processed in this run: {total_notes_processed:,}")
+        print(f"Matches found in this run: {total_matches:,}")
+        print(f"Match rate: {total_matches/total_notes_processed*100:.2f}%")
+        print(f"Processing speed: {total_notes_processed/elapsed_time:.1f} notes/second")
+    print(f"Time elapsed: {elapsed_time/60:.1f} minutes")
+
+    if errors:
+        print(f"\n⚠️  Errors encountered: {len(errors)}")
+        for error in errors[:5]:
+            print(f"  - {error}")
+
+    # Merge all intermediate results
+    print(f"\n{'='*80}")
+    print("Merging all intermediate results...")
+    print(f"{'='*80}")
+
+    all_intermediate_files = glob.glob(f'{intermediate_path}*_results.parquet')
+    print(f"Found {len(all_intermediate_files)} intermediate result files to merge")
+
+    if all_intermediate_files:
+        # Read and concatenate all intermediate files in parallel with DuckDB
+        # (union_by_name tolerates column types that differ between files).
+        # Rows are fetched as Python objects rather than with .df(): .df() turns list
+        # columns into numpy arrays, which to_csv writes without commas between items,
+        # while Python lists are written as valid list literals
+        merged = duckdb.sql(f"""
+        SELECT * FROM read_parquet('{intermediate_path}*_results.parquet', union_by_name = true)
+        """)
+        final_df = pd.DataFrame(merged.fetchall(), columns=merged.columns)
+        # Write sentence offsets as (start, length) pairs, e.g. [(87, 18), (120, 42)]
+        final_df['matched_sentence_offsets'] = final_df['matched_sentence_offsets'].map(
+            lambda offsets: [tuple(pair) for pair in offsets])
     
-    if all_results:
-        # Concatenate all results
-        final_df = pd.concat(all_results, ignore_index=True)
+        if len(final_df) > 0:
         
-        # Show statistics
-        print(f"\n{'='*80}")
-        print("Final Statistics:")
-        print(f"{'='*80}")
-        print(f"Total notes with AUD keywords: {len(final_df)}")
-        print(f"Total unique patients: {final_df['person_id'].nunique()}")
-        print(f"Total unique notes: {final_df['note_id'].nunique()}")
-        print(f"Average aud_roots per note: {final_df['aud_roots_count'].mean():.2f}")
+            # Show statistics
+            print(f"\n{'='*80}")
+            print("Final Statistics:")
+            print(f"{'='*80}")
+            print(f"Total notes with AUD keywords: {len(final_df)}")
+            print(f"Total unique patients: {final_df['person_id'].nunique()}")
+            print(f"Total unique notes: {final_df['note_id'].nunique()}")
+            print(f"Average aud_roots per note: {final_df['aud_roots_count'].mean():.2f}")
         
-        print(f"\nAUD roots distribution:")
-        print(final_df['aud_roots_count'].value_counts().sort_index().head(10))
+            print(f"\nAUD roots distribution:")
+            print(final_df['aud_roots_count'].value_counts().sort_index().head(10))
         
-        # Save final merged results
-        output_path = f'{results_path}aud_notes_keywords.csv'
-        final_df.to_csv(output_path, index=False)
-        print(f"\n✓ Final results saved to: {output_path}")
+            # Save final merged results
+            output_path = f'{results_path}aud_notes_keywords.csv'
+            final_df.to_csv(output_path, index=False)
+            print(f"\n✓ Final results saved to: {output_path}")
         
-        # Show sample
-        print(f"\nSample of results (first 3 rows):")
-        print(final_df[['person_id', 'note_id', 'note_date', 'aud_roots_count']].head(3))
+            # Show sample
+            print(f"\nSample of results (first 3 rows):")
+            print(final_df[['person_id', 'note_id', 'note_date', 'aud_roots_count']].head(3))
+        else:
+            print("No valid intermediate results to merge.")
     else:
-        print("No valid intermediate results to merge.")
-else:
-    print("No intermediate results found.")
-
-print(f"\n{'='*80}")
-print(f"✓ All done!")
-print(f"{'='*80}")
-print(f"Files processed: {processed_count + skipped_count}/{total_files}")
-if processed_count > 0:
-    print(f"  - Newly processed: {processed_count}")
-    print(f"  - Skipped: {skipped_count}")
-print(f"Intermediate files: {intermediate_path}")
-print(f"Final results: {results_path}aud_notes_keywords.csv")
-print(f"Total time: {elapsed_time/60:.1f} minutes")
+        print("No intermediate results found.")
+
+    print(f"\n{'='*80}")
+    print(f"✓ All done!")
+    print(f"{'='*80}")
+    print(f"Files processed: {processed_count + skipped_count}/{total_files}")
+    if processed_count > 0:
+        print(f"  - Newly processed: {processed_count}")
+        print(f"  - Skipped: {skipped_count}")
+    print(f"Intermediate files: {intermediate_path}")
+    print(f"Final results: {results_path}aud_notes_keywords.csv")
+    print(f"Total time: {elapsed_time/60:.1f} minutes")
@@ -0,0 +1,25 @@
+import os
+
+
+def csv_to_parquet(con, csv_path, cache_dir):
+    """
+    Convert a source CSV to ZSTD-compressed Parquet in cache_dir and return the Parquet path.
+    Later runs reuse the cached Parquet file and skip CSV parsing entirely, unless the
+    CSV has been modified since it was converted. The cached file is also used when the CSV
+    has since been removed or archived. The source data directory is never written to.
+    """
+    table_name = os.path.splitext(os.path.basename(csv_path))[0]
+    parquet_path = os.path.join(cache_dir, f'{table_name}.parquet')
+    if (not os.path.exists(parquet_path)
+            or (os.path.exists(csv_path)
+                and os.path.getmtime(parquet_path) < os.path.getmtime(csv_path))):
+        print(f'Converting {table_name}.csv to Parquet (cached in {cache_dir})...')
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so an interrupted conversion is never reused
+        tmp_path = parquet_path + '.tmp'
+        con.execute(f"""
+        COPY (SELECT * FROM read_csv_auto('{csv_path}'))
+        TO '{tmp_path}' (FORMAT PARQUET, ROW_GROUP_SIZE 100000, COMPRESSION ZSTD)
+        """)
+        os.replace(tmp_path, parquet_path)
+    return parquet_path